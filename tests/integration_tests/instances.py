@@ -1,12 +1,16 @@
 # This file is part of cloud-init. See LICENSE file for license information.
+import base64
+import io
 import logging
 import os
 import re
+import tarfile
+import time
 import uuid
 from enum import Enum
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import Union
+from typing import Dict, List, Union
 
 from pycloudlib.gce.instance import GceInstance
 from pycloudlib.instance import BaseInstance
@@ -30,6 +34,9 @@ except ImportError:
 
 log = logging.getLogger("integration_testing")
 
+# Separates the outputs of several commands run in one remote command
+OUTPUT_DELIMITER = "<<cloud-init-output-delimiter>>"
+
 
 def _get_tmp_path():
     tmp_filename = str(uuid.uuid4())
@@ -125,6 +132,26 @@ class IntegrationInstance:
             )
         return result.stdout
 
+    def read_from_files(self, *remote_paths) -> List[str]:
+        """Read several remote files using a single command."""
+        command = f" && printf '{OUTPUT_DELIMITER}' && ".join(
+            "cat {}".format(remote_path) for remote_path in remote_paths
+        )
+        result = self.execute(command)
+        if result.failed:
+            raise IOError(
+                "Failed reading remote files via cat: {}\n"
+                "Return code: {}\n"
+                "Stderr: {}\n"
+                "Stdout: {}".format(
+                    ", ".join(map(str, remote_paths)),
+                    result.return_code,
+                    result.stderr,
+                    result.stdout,
+                )
+            )
+        return result.stdout.split(OUTPUT_DELIMITER)
+
     def write_to_file(self, remote_path, contents: str):
         # Writes file locally and then pushes it rather
         # than writing the file directly on the instance
@@ -136,6 +163,38 @@ class IntegrationInstance:
         finally:
             os.unlink(tmp_file.name)
 
+    def write_to_files(self, files: Dict[str, str]):
+        """Write several remote files using a single command.
+
+        `files` maps absolute remote paths to their contents. They are sent
+        as a gzipped tarball and extracted on the instance with mode 0644.
+        """
+        tarball = io.BytesIO()
+        with tarfile.open(fileobj=tarball, mode="w:gz") as tar:
+            for remote_path, contents in files.items():
+                data = contents.encode()
+                info = tarfile.TarInfo(remote_path.lstrip("/"))
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+        encoded = base64.b64encode(tarball.getvalue()).decode()
+        result = self.execute(
+            f"echo {encoded} | base64 -d | tar -C / -xz --no-same-owner"
+        )
+        if result.failed:
+            raise IOError(
+                "Failed writing remote files via tar: {}\n"
+                "Return code: {}\n"
+                "Stderr: {}\n"
+                "Stdout: {}".format(
+                    ", ".join(files),
+                    result.return_code,
+                    result.stderr,
+                    result.stdout,
+                )
+            )
+
     def snapshot(self):
         image_id = self.cloud.snapshot(self.instance)
         log.info("Created new image: %s", image_id)
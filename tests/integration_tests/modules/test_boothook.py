@@ -15,6 +15,8 @@ echo BOOTHOOKstdout
 echo "BOOTHOOK: $INSTANCE_ID: is called every boot." >> /boothook.txt
 """
 
+BOOTHOOK_MSG = "BOOTHOOK: {}: is called every boot"
+
 
 @pytest.mark.user_data(USER_DATA)
 def test_boothook_header_runs_part_per_instance(client: IntegrationInstance):
@@ -22,14 +24,14 @@ def test_boothook_header_runs_part_per_instance(client: IntegrationInstance):
     Streams stderr and stdout are directed to /var/log/cloud-init-output.log.
     """
     instance_id = client.instance.execute("cloud-init query instance-id")
-    RE_BOOTHOOK = f"BOOTHOOK: {instance_id}: is called every boot"
+    re_boothook = re.compile(re.escape(BOOTHOOK_MSG.format(instance_id)))
     log = client.read_from_file("/var/log/cloud-init.log")
     verify_clean_log(log)
     output = client.read_from_file("/boothook.txt")
-    assert 1 == len(re.findall(RE_BOOTHOOK, output))
+    assert 1 == len(re_boothook.findall(output))
     client.restart()
     output = client.read_from_file("/boothook.txt")
-    assert 2 == len(re.findall(RE_BOOTHOOK, output))
+    assert 2 == len(re_boothook.findall(output))
     output_log = client.read_from_file("/var/log/cloud-init-output.log")
     expected_msgs = [
         "BOOTHOOKstdout",
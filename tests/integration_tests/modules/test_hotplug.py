@@ -1,3 +1,6 @@
+import json
+import re
+import shlex
 import time
 from collections import namedtuple
 
@@ -5,9 +8,11 @@ import paramiko
 import pytest
 import yaml
 
-from cloudinit.subp import subp
 from tests.integration_tests.clouds import IntegrationCloud
-from tests.integration_tests.instances import IntegrationInstance
+from tests.integration_tests.instances import (
+    OUTPUT_DELIMITER,
+    IntegrationInstance,
+)
 from tests.integration_tests.integration_settings import PLATFORM
 from tests.integration_tests.releases import (
     CURRENT_RELEASE,
@@ -15,7 +20,8 @@ from tests.integration_tests.releases import (
     UBUNTU_STABLE,
 )
 from tests.integration_tests.util import (
-    push_and_enable_systemd_unit,
+    YamlSafeLoader,
+    get_unreachable_hosts,
     verify_clean_log,
     wait_for_cloud_init,
 )
@@ -36,55 +42,183 @@ updates:
 
 ip_addr = namedtuple("ip_addr", "interface state ip4 ip6")
 
+HOTPLUG_EXIT_MSG = "Exiting hotplug handler"
+HOTPLUG_FATAL_MSG = "Received fatal exception handling hotplug!"
+HOTPLUG_UDEV_RULES = "/etc/udev/rules.d/90-cloud-init-hook-hotplug.rules"
+
+# Follow the log until it holds `runs` handler results, successful or not
+# (a failed run logs the fatal message instead of the exit one). tail would
+# only notice grep is gone on its next write, so stop it.
+# Exit codes: 0 once enough runs were logged, 1 if tail ended early and,
+# from the timeout(1) wrapper, 124 when the runs were not logged in time.
+HOTPLUG_WAIT_SCRIPT = """\
+tail -n +1 -F {log} 2>/dev/null | {{
+    n=$(grep -m {runs} -c -F -e "{exit_msg}" -e "{fatal_msg}")
+    pkill -P $$ -x tail
+    [ "$n" -ge {runs} ]
+}}
+"""
+
+
+class IPTable:
+    """Interface addresses, indexed by interface name and by ip4."""
+
+    def __init__(self, ips):
+        self.ips = ips
+        self.by_iface = {ip.interface: ip for ip in ips}
+        self.by_ip4 = {ip.ip4: ip for ip in ips if ip.ip4}
+        self.ip4_set = frozenset(self.by_ip4)
+
+    def __getitem__(self, index):
+        return self.ips[index]
+
+    def __iter__(self):
+        return iter(self.ips)
+
+    def __len__(self):
+        return len(self.ips)
+
+
+def _poll(timeout: float = 60, delay: float = 0.05, max_delay: float = 1):
+    """Yield until timeout, sleeping with exponential backoff in between.
+
+    Only the time slept counts against the timeout, as the loop this
+    replaces did, so slow polls (e.g. ssh reconnecting while the instance
+    boots) don't eat into the wait.
+    """
+    slept = 0.0
+    while True:
+        yield
+        if slept + delay > timeout:
+            return
+        time.sleep(delay)
+        slept += delay
+        delay = min(delay * 1.5, max_delay)
+
+
+def _wait_till_hotplug_complete(client, expected_runs=1, timeout=60):
+    # Block on the instance instead of polling from here, then check the
+    # outcome with one more round-trip. The hotplugd state is checked on
+    # timeouts too, as a failure before the handler starts logs nothing.
+    log = "/var/log/cloud-init.log"
+    result = None
+    if expected_runs:
+        script = HOTPLUG_WAIT_SCRIPT.format(
+            log=log,
+            runs=expected_runs,
+            exit_msg=HOTPLUG_EXIT_MSG,
+            fatal_msg=HOTPLUG_FATAL_MSG,
+        )
+        result = client.execute(
+            f"timeout {timeout} sh -c {shlex.quote(script)}"
+        )
+    out = client.execute(
+        f'grep -c -F "{HOTPLUG_EXIT_MSG}" {log};'
+        f' grep -c -F "{HOTPLUG_FATAL_MSG}" {log};'
+        " command -v systemctl >/dev/null &&"
+        " systemctl is-active cloud-init-hotplugd.service"
+    )
+    runs, fatal, *state = out.split()
+    if state == ["failed"]:
+        r = client.execute("systemctl status cloud-init-hotplugd.service")
+        raise AssertionError(f"cloud-init-hotplugd.service failed: {r}")
+    if int(fatal):
+        r = client.execute(f"grep -F -A 30 '{HOTPLUG_FATAL_MSG}' {log}")
+        raise AssertionError(f"Hotplug handler failed: {r}")
+    if result is not None and result.return_code == 124:
+        raise Exception(
+            f"Timed out after {timeout}s waiting for {expected_runs}"
+            " hotplug handler run(s)"
+        )
+    if int(runs) != expected_runs:
+        raise Exception("Waiting for hotplug handler failed")
+
 
-def _wait_till_hotplug_complete(client, expected_runs=1):
-    for _ in range(60):
-        if client.execute("command -v systemctl").ok:
-            if "failed" == client.execute(
-                "systemctl is-active cloud-init-hotplugd.service"
-            ):
-                r = client.execute(
-                    "systemctl status cloud-init-hotplugd.service"
-                )
-                if not r.ok:
-                    raise AssertionError(
-                        "cloud-init-hotplugd.service failed: {r.stdout}"
-                    )
-
-        log = client.read_from_file("/var/log/cloud-init.log")
-        if log.count("Exiting hotplug handler") == expected_runs:
-            return log
+class TailReader:
+    """Read a remote file incrementally, fetching only appended content."""
+
+    def __init__(self, client, path="/var/log/cloud-init.log"):
+        self.client = client
+        self.path = path
+        self.offset = 0
+
+    def read_new_cmd(self) -> str:
+        """Shell command printing the file size and the unread content."""
+        return (
+            f"size=$(stat -c %s {self.path});"
+            f" printf '%s{OUTPUT_DELIMITER}' \"$size\";"
+            f" tail -c +{self.offset + 1} {self.path}"
+            f" | head -c $((size - {self.offset}))"
+        )
+
+    def consume(self, output: str) -> str:
+        """Advance past the output of ``read_new_cmd`` and return new text."""
+        size, new_content = output.split(OUTPUT_DELIMITER, 1)
+        self.offset = int(size)
+        return new_content
+
+    def read_new(self) -> str:
+        """Return what was written to the file since the previous read."""
+        return self.consume(self.client.execute(self.read_new_cmd()))
+
+
+def _collect_initial_state(client, log: TailReader):
+    """Return interfaces, hotplug udev rules presence and new log content.
+
+    Everything is gathered with a single remote command.
+    """
+    out = client.execute(
+        f"ip -j addr show; printf '{OUTPUT_DELIMITER}';"
+        f" test -f {HOTPLUG_UDEV_RULES} && echo yes;"
+        f" printf '{OUTPUT_DELIMITER}'; {log.read_new_cmd()}"
+    )
+    ip_output, rules, log_output = out.split(OUTPUT_DELIMITER, 2)
+    interfaces = json.loads(ip_output)
+    if any(map(_waiting_for_ipv6, interfaces)):
+        # Same retries as _get_ip_addr, counting this read as the first
         time.sleep(1)
-    raise Exception("Waiting for hotplug handler failed")
+        ips = _get_ip_addr(client, _retries=1)
+    else:
+        ips = _ip_table_from_json(interfaces)
+    return ips, rules.strip() == "yes", log.consume(log_output)
+
+
+def _has_netplan_ethernet(netplan_cfg: str, interface: str) -> bool:
+    # Cheaper than parsing the whole config for a single key lookup
+    return bool(
+        re.search(
+            rf"^\s+{re.escape(interface)}:\s*$", netplan_cfg, re.MULTILINE
+        )
+    )
+
+
+def _ip_addr_from_json(interface: dict):
+    addresses = interface.get("addr_info", [])
+    ip4 = next((a["local"] for a in addresses if a["family"] == "inet"), None)
+    ip6 = next((a["local"] for a in addresses if a["family"] == "inet6"), None)
+    return ip_addr(interface["ifname"], interface["operstate"], ip4, ip6)
+
+
+def _waiting_for_ipv6(interface: dict) -> bool:
+    # An interface with a metric'd ipv4 and only a link-local ipv6 has not
+    # got its ipv6 address yet
+    addresses = interface.get("addr_info", [])
+    ip6_scopes = [a.get("scope") for a in addresses if a["family"] == "inet6"]
+    return ip6_scopes == ["link"] and any(
+        a["family"] == "inet" and "metric" in a for a in addresses
+    )
 
 
 def _get_ip_addr(client, *, _retries: int = 0):
-    ips = []
-    lines = client.execute("ip --brief addr").split("\n")
-    for line in lines:
-        attributes = line.split()
-        interface, state = attributes[0], attributes[1]
-        ip4_cidr = attributes[2] if len(attributes) > 2 else None
-
-        # Retry to wait for ipv6_cidr:
-        # ens6 UP <ipv4_cidr> metric 200 <ipv6_cidr> <ipv6_cidr scope link>
-        if len(attributes) == 6 and _retries < 3:
-            time.sleep(1)
-            return _get_ip_addr(client, _retries=_retries + 1)
-
-        # The output of `ip --brief addr` can contain metric info:
-        # ens5 UP <ipv4_cidr> metric 100 <ipv6_cidr> ...
-        ip6_cidr = None
-        if len(attributes) > 3:
-            if attributes[3] != "metric":
-                ip6_cidr = attributes[3]
-            elif len(attributes) > 5:
-                ip6_cidr = attributes[5]
-        ip4 = ip4_cidr.split("/")[0] if ip4_cidr else None
-        ip6 = ip6_cidr.split("/")[0] if ip6_cidr else None
-        ip = ip_addr(interface, state, ip4, ip6)
-        ips.append(ip)
-    return ips
+    interfaces = json.loads(client.execute("ip -j addr show"))
+    if _retries < 3 and any(map(_waiting_for_ipv6, interfaces)):
+        time.sleep(1)
+        return _get_ip_addr(client, _retries=_retries + 1)
+    return _ip_table_from_json(interfaces)
+
+
+def _ip_table_from_json(interfaces: list) -> IPTable:
+    return IPTable([_ip_addr_from_json(iface) for iface in interfaces])
 
 
 @pytest.mark.skipif(
@@ -99,38 +233,35 @@ def _get_ip_addr(client, *, _retries: int = 0):
 )
 @pytest.mark.user_data(USER_DATA)
 def test_hotplug_add_remove(client: IntegrationInstance):
-    ips_before = _get_ip_addr(client)
-    log = client.read_from_file("/var/log/cloud-init.log")
-    assert "Exiting hotplug handler" not in log
-    assert client.execute(
-        "test -f /etc/udev/rules.d/90-cloud-init-hook-hotplug.rules"
-    ).ok
+    ips_before, hotplug_rules, log = _collect_initial_state(
+        client, TailReader(client)
+    )
+    assert HOTPLUG_EXIT_MSG not in log
+    assert hotplug_rules
 
     # Add new NIC
     added_ip = client.instance.add_network_interface()
     _wait_till_hotplug_complete(client, expected_runs=1)
     ips_after_add = _get_ip_addr(client)
-    new_addition = [ip for ip in ips_after_add if ip.ip4 == added_ip][0]
+    new_addition = ips_after_add.by_ip4[added_ip]
 
     assert len(ips_after_add) == len(ips_before) + 1
-    assert added_ip not in [ip.ip4 for ip in ips_before]
-    assert added_ip in [ip.ip4 for ip in ips_after_add]
+    assert added_ip not in ips_before.ip4_set
+    assert added_ip in ips_after_add.ip4_set
     assert new_addition.state == "UP"
 
     netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-    config = yaml.safe_load(netplan_cfg)
-    assert new_addition.interface in config["network"]["ethernets"]
+    assert _has_netplan_ethernet(netplan_cfg, new_addition.interface)
 
     # Remove new NIC
     client.instance.remove_network_interface(added_ip)
     _wait_till_hotplug_complete(client, expected_runs=2)
     ips_after_remove = _get_ip_addr(client)
     assert len(ips_after_remove) == len(ips_before)
-    assert added_ip not in [ip.ip4 for ip in ips_after_remove]
+    assert added_ip not in ips_after_remove.ip4_set
 
     netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-    config = yaml.safe_load(netplan_cfg)
-    assert new_addition.interface not in config["network"]["ethernets"]
+    assert not _has_netplan_ethernet(netplan_cfg, new_addition.interface)
 
     assert "enabled" == client.execute(
         "cloud-init devel hotplug-hook -s net query"
@@ -147,23 +278,20 @@ def _test_hotplug_enabled_by_cmd(client: IntegrationInstance):
     )
     ret = client.execute("cloud-init devel hotplug-hook -s net enable")
     assert ret.ok, ret.stderr
-    log = client.read_from_file("/var/log/cloud-init.log")
+    log = TailReader(client)
     assert (
         "hotplug-hook called with the following arguments: "
-        "{hotplug_action: enable" in log
+        "{hotplug_action: enable" in log.read_new()
     )
 
     assert "enabled" == client.execute(
         "cloud-init devel hotplug-hook -s net query"
     )
-    log = client.read_from_file("/var/log/cloud-init.log")
     assert (
         "hotplug-hook called with the following arguments: "
-        "{hotplug_action: query" in log
+        "{hotplug_action: query" in log.read_new()
     )
-    assert client.execute(
-        "test -f /etc/udev/rules.d/90-cloud-init-hook-hotplug.rules"
-    ).ok
+    assert client.execute(f"test -f {HOTPLUG_UDEV_RULES}").ok
 
 
 @pytest.mark.user_data(USER_DATA_HOTPLUG_DISABLED)
@@ -187,27 +315,25 @@ def test_hotplug_enable_cmd_ec2(client: IntegrationInstance):
     added_ip = client.instance.add_network_interface()
     _wait_till_hotplug_complete(client, expected_runs=4)
     ips_after_add = _get_ip_addr(client)
-    new_addition = [ip for ip in ips_after_add if ip.ip4 == added_ip][0]
+    new_addition = ips_after_add.by_ip4[added_ip]
 
     assert len(ips_after_add) == len(ips_before) + 1
-    assert added_ip not in [ip.ip4 for ip in ips_before]
-    assert added_ip in [ip.ip4 for ip in ips_after_add]
+    assert added_ip not in ips_before.ip4_set
+    assert added_ip in ips_after_add.ip4_set
     assert new_addition.state == "UP"
 
     netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-    config = yaml.safe_load(netplan_cfg)
-    assert new_addition.interface in config["network"]["ethernets"]
+    assert _has_netplan_ethernet(netplan_cfg, new_addition.interface)
 
     # Remove new NIC
     client.instance.remove_network_interface(added_ip)
     _wait_till_hotplug_complete(client, expected_runs=5)
     ips_after_remove = _get_ip_addr(client)
     assert len(ips_after_remove) == len(ips_before)
-    assert added_ip not in [ip.ip4 for ip in ips_after_remove]
+    assert added_ip not in ips_after_remove.ip4_set
 
     netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-    config = yaml.safe_load(netplan_cfg)
-    assert new_addition.interface not in config["network"]["ethernets"]
+    assert not _has_netplan_ethernet(netplan_cfg, new_addition.interface)
 
 
 @pytest.mark.skipif(
@@ -217,23 +343,23 @@ def test_hotplug_enable_cmd_ec2(client: IntegrationInstance):
     ),
 )
 def test_no_hotplug_in_userdata(client: IntegrationInstance):
-    ips_before = _get_ip_addr(client)
-    log = client.read_from_file("/var/log/cloud-init.log")
-    assert "Exiting hotplug handler" not in log
-    assert client.execute(
-        "test -f /etc/udev/rules.d/90-cloud-init-hook-hotplug.rules"
-    ).failed
+    log = TailReader(client)
+    ips_before, hotplug_rules, log_content = _collect_initial_state(
+        client, log
+    )
+    assert HOTPLUG_EXIT_MSG not in log_content
+    assert "hotplug-hook" not in log_content
+    assert not hotplug_rules
 
     # Add new NIC
     client.instance.add_network_interface()
-    log = client.read_from_file("/var/log/cloud-init.log")
-    assert "hotplug-hook" not in log
+    assert "hotplug-hook" not in log.read_new()
 
     ips_after_add = _get_ip_addr(client)
     if len(ips_after_add) == len(ips_before) + 1:
         # We can see the device, but it should not have been brought up
-        new_ip = [ip for ip in ips_after_add if ip not in ips_before][0]
-        assert new_ip.state == "DOWN"
+        [new_iface] = ips_after_add.by_iface.keys() - ips_before.by_iface
+        assert ips_after_add.by_iface[new_iface].state == "DOWN"
     else:
         assert len(ips_after_add) == len(ips_before)
 
@@ -254,16 +380,16 @@ def test_multi_nic_hotplug(setup_image, session_cloud: IntegrationCloud):
         )
         _wait_till_hotplug_complete(client, expected_runs=1)
 
-        log_content = client.read_from_file("/var/log/cloud-init.log")
+        log_content, netplan_cfg = client.read_from_files(
+            "/var/log/cloud-init.log",
+            "/etc/netplan/50-cloud-init.yaml",
+        )
         verify_clean_log(log_content)
 
         ips_after_add = _get_ip_addr(client)
 
-        netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-        config = yaml.safe_load(netplan_cfg)
-        new_addition = [
-            ip for ip in ips_after_add if ip.ip4 == secondary_priv_ip
-        ][0]
+        config = yaml.load(netplan_cfg, Loader=YamlSafeLoader)
+        new_addition = ips_after_add.by_ip4[secondary_priv_ip]
         assert new_addition.interface in config["network"]["ethernets"]
         new_nic_cfg = config["network"]["ethernets"][new_addition.interface]
         assert [{"from": secondary_priv_ip, "table": 101}] == new_nic_cfg[
@@ -275,8 +401,7 @@ def test_multi_nic_hotplug(setup_image, session_cloud: IntegrationCloud):
         assert len(public_ips) == 2
 
         # SSH over all public ips works
-        for pub_ip in public_ips:
-            subp("nc -w 5 -zv " + pub_ip + " 22", shell=True)
+        assert not get_unreachable_hosts(public_ips)
 
         # Remove new NIC
         client.instance.remove_network_interface(secondary_priv_ip)
@@ -285,17 +410,18 @@ def test_multi_nic_hotplug(setup_image, session_cloud: IntegrationCloud):
         public_ips = client.instance.public_ips
         assert len(public_ips) == 1
         # SSH over primary NIC works
-        subp("nc -w 1 -zv " + public_ips[0] + " 22", shell=True)
+        assert not get_unreachable_hosts(public_ips[:1], timeout=1)
 
         ips_after_remove = _get_ip_addr(client)
         assert len(ips_after_remove) == len(ips_before)
-        assert secondary_priv_ip not in [ip.ip4 for ip in ips_after_remove]
+        assert secondary_priv_ip not in ips_after_remove.ip4_set
 
-        netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-        config = yaml.safe_load(netplan_cfg)
-        assert new_addition.interface not in config["network"]["ethernets"]
+        netplan_cfg, log_content = client.read_from_files(
+            "/etc/netplan/50-cloud-init.yaml",
+            "/var/log/cloud-init.log",
+        )
+        assert not _has_netplan_ethernet(netplan_cfg, new_addition.interface)
 
-        log_content = client.read_from_file("/var/log/cloud-init.log")
         verify_clean_log(log_content)
 
 
@@ -314,20 +440,20 @@ def test_multi_nic_hotplug_vpc(setup_image, session_cloud: IntegrationCloud):
         client.instance.add_network_interface(ipv6_address_count=1)
 
         _wait_till_hotplug_complete(client)
-        log_content = client.read_from_file("/var/log/cloud-init.log")
+        log_content, netplan_cfg = client.read_from_files(
+            "/var/log/cloud-init.log",
+            "/etc/netplan/50-cloud-init.yaml",
+        )
         verify_clean_log(log_content)
 
-        netplan_cfg = client.read_from_file("/etc/netplan/50-cloud-init.yaml")
-        config = yaml.safe_load(netplan_cfg)
+        config = yaml.load(netplan_cfg, Loader=YamlSafeLoader)
 
         ips_after_add = _get_ip_addr(client)
         secondary_priv_ip4 = ips_after_add[2].ip4
         secondary_priv_ip6 = ips_after_add[2].ip6
         assert primary_priv_ip4 != secondary_priv_ip4
 
-        new_addition = [
-            ip for ip in ips_after_add if ip.ip4 == secondary_priv_ip4
-        ][0]
+        new_addition = ips_after_add.by_ip4[secondary_priv_ip4]
         assert new_addition.interface in config["network"]["ethernets"]
         new_nic_cfg = config["network"]["ethernets"][new_addition.interface]
         assert "routing-policy" in new_nic_cfg
@@ -379,7 +505,7 @@ def test_no_hotplug_triggered_by_docker(client: IntegrationInstance):
 
     # Verify hotplug-hook was not called
     log = client.read_from_file("/var/log/cloud-init.log")
-    assert "Exiting hotplug handler" not in log
+    assert HOTPLUG_EXIT_MSG not in log
     assert "hotplug-hook" not in log
 
     # Verify hotplug was enabled
@@ -391,7 +517,7 @@ def test_no_hotplug_triggered_by_docker(client: IntegrationInstance):
 def wait_for_cmd(
     client: IntegrationInstance, cmd: str, return_code: int
 ) -> None:
-    for _ in range(60):
+    for _ in _poll():
         try:
             res = client.execute(cmd)
         except paramiko.ssh_exception.SSHException:
@@ -399,7 +525,6 @@ def wait_for_cmd(
         else:
             if res.return_code == return_code:
                 return
-        time.sleep(1)
     assert False, f"`{cmd}` never exited with {return_code}"
 
 
@@ -461,15 +586,19 @@ WantedBy=cloud-final.service
 
 
 def _customize_environment(client: IntegrationInstance):
-    push_and_enable_systemd_unit(
-        client, "block-cloud-config.service", BLOCK_CLOUD_CONFIG
-    )
-    push_and_enable_systemd_unit(
-        client, "block-cloud-final.service", BLOCK_CLOUD_FINAL
+    client.write_to_files(
+        {
+            "/etc/systemd/system/block-cloud-config.service": (
+                BLOCK_CLOUD_CONFIG
+            ),
+            "/etc/systemd/system/block-cloud-final.service": (
+                BLOCK_CLOUD_FINAL
+            ),
+        }
     )
 
-    # Disable pam_nologin for 1000(ubuntu) user to allow ssh access early
-    # during boot. Without this we get:
+    # Enable the blocking units and disable pam_nologin for 1000(ubuntu)
+    # user to allow ssh access early during boot. Without the latter we get:
     #
     # System is booting up. Unprivileged users are not permitted to log in yet.
     # Please come back later. For technical details, see pam_nologin(8).
@@ -478,12 +607,12 @@ def _customize_environment(client: IntegrationInstance):
     # configuration [preauth]
     #
     # See: pam(7), pam_nologin(8), pam_succeed_id(8)
-    contents = client.read_from_file("/etc/pam.d/sshd")
-    contents = (
-        "account [success=1 default=ignore] pam_succeed_if.so quiet uid eq"
-        " 1000\n\n" + contents
-    )
-    client.write_to_file("/etc/pam.d/sshd", contents)
+    assert client.execute(
+        "systemctl enable block-cloud-config.service"
+        " block-cloud-final.service"
+        " && sed -i '1i account [success=1 default=ignore]"
+        " pam_succeed_if.so quiet uid eq 1000' /etc/pam.d/sshd"
+    ).ok
 
     client.instance.shutdown(wait=True)
     client.instance.start(wait=False)
@@ -2,14 +2,18 @@
 
 import contextlib
 import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 import pytest
 import yaml
 
-from cloudinit.subp import subp
 from tests.integration_tests import random_mac_address
 from tests.integration_tests.clouds import IntegrationCloud
-from tests.integration_tests.instances import IntegrationInstance
+from tests.integration_tests.instances import (
+    OUTPUT_DELIMITER,
+    IntegrationInstance,
+)
 from tests.integration_tests.integration_settings import PLATFORM
 from tests.integration_tests.releases import (
     CURRENT_RELEASE,
@@ -18,7 +22,12 @@ from tests.integration_tests.releases import (
     MANTIC,
     NOBLE,
 )
-from tests.integration_tests.util import verify_clean_log
+from tests.integration_tests.util import (
+    YamlSafeDumper,
+    YamlSafeLoader,
+    get_unreachable_hosts,
+    verify_clean_log,
+)
 
 # Older Ubuntu series didn't read cloud-init.* config keys
 LXD_NETWORK_CONFIG_KEY = (
@@ -30,8 +39,9 @@ LXD_NETWORK_CONFIG_KEY = (
 
 def _add_dummy_bridge_to_netplan(client: IntegrationInstance):
     # Update netplan configuration to ensure it doesn't change on reboot
-    netplan = yaml.safe_load(
-        client.execute("cat /etc/netplan/50-cloud-init.yaml")
+    netplan = yaml.load(
+        client.execute("cat /etc/netplan/50-cloud-init.yaml"),
+        Loader=YamlSafeLoader,
     )
     # Just a dummy bridge to do nothing
     try:
@@ -39,10 +49,44 @@ def _add_dummy_bridge_to_netplan(client: IntegrationInstance):
     except KeyError:
         netplan["network"]["bridges"] = {"dummy0": {"dhcp4": False}}
 
-    dumped_netplan = yaml.dump(netplan)
+    dumped_netplan = yaml.dump(netplan, Dumper=YamlSafeDumper)
     client.write_to_file("/etc/netplan/50-cloud-init.yaml", dumped_netplan)
 
 
+def _netplan_equal(netplan_cfg: str, other_netplan_cfg: str) -> bool:
+    # Identical content is equal without having to parse it
+    return netplan_cfg == other_netplan_cfg or yaml.load(
+        netplan_cfg, Loader=YamlSafeLoader
+    ) == yaml.load(other_netplan_cfg, Loader=YamlSafeLoader)
+
+
+def _read_and_rotate_log(client: IntegrationInstance) -> List[str]:
+    """Return cloud-init.log and the netplan config, then move the log away.
+
+    Everything happens in one remote command, so the next boot starts a
+    fresh log.
+    """
+    result = client.execute(
+        "cat /var/log/cloud-init.log"
+        f" && printf '{OUTPUT_DELIMITER}'"
+        " && cat /etc/netplan/50-cloud-init.yaml"
+        " && mv /var/log/cloud-init.log /var/log/cloud-init.log.bak"
+    )
+    if result.failed:
+        raise IOError(
+            "Failed reading cloud-init.log and netplan config or moving the"
+            " log to cloud-init.log.bak\n"
+            "Return code: {}\n"
+            "Stderr: {}\n"
+            "Stdout: {}".format(
+                result.return_code,
+                result.stderr,
+                result.stdout,
+            )
+        )
+    return result.stdout.split(OUTPUT_DELIMITER)
+
+
 USER_DATA = """\
 #cloud-config
 updates:
@@ -61,12 +105,9 @@ updates:
 @pytest.mark.user_data(USER_DATA)
 class TestNetplanGenerateBehaviorOnReboot:
     def test_skip(self, client: IntegrationInstance):
-        log = client.read_from_file("/var/log/cloud-init.log")
+        log, netplan_cfg = _read_and_rotate_log(client)
         assert "Applying network configuration" in log
         assert "Selected renderer 'netplan'" in log
-        client.execute(
-            "mv /var/log/cloud-init.log /var/log/cloud-init.log.bak"
-        )
         if CURRENT_RELEASE < MANTIC:
             assert (
                 "No netplan python module. Fallback to write"
@@ -74,13 +115,12 @@ class TestNetplanGenerateBehaviorOnReboot:
             )
         else:
             assert "Rendered netplan config using netplan python API" in log
-        netplan = yaml.safe_load(
-            client.execute("cat /etc/netplan/50-cloud-init.yaml")
-        )
 
         client.restart()
 
-        log = client.read_from_file("/var/log/cloud-init.log")
+        log, netplan_cfg_new = client.read_from_files(
+            "/var/log/cloud-init.log", "/etc/netplan/50-cloud-init.yaml"
+        )
         assert "Event Allowed: scope=network EventType=boot" in log
         assert "Applying network configuration" in log
         assert "Running command ['netplan', 'generate']" not in log
@@ -88,27 +128,22 @@ class TestNetplanGenerateBehaviorOnReboot:
             "skipping call to `netplan generate`."
             " reason: identical netplan config"
         ) in log
-        netplan_new = yaml.safe_load(
-            client.execute("cat /etc/netplan/50-cloud-init.yaml")
-        )
-        assert netplan == netplan_new, "no changes expected in netplan config"
+        assert _netplan_equal(
+            netplan_cfg, netplan_cfg_new
+        ), "no changes expected in netplan config"
 
     def test_applied(self, client: IntegrationInstance):
-        log = client.read_from_file("/var/log/cloud-init.log")
-        assert "Applying network configuration" in log
-        assert "Selected renderer 'netplan'" in log
-        client.execute(
-            "mv /var/log/cloud-init.log /var/log/cloud-init.log.bak"
-        )
         # fake a change in the rendered network config file
         _add_dummy_bridge_to_netplan(client)
-        netplan = yaml.safe_load(
-            client.execute("cat /etc/netplan/50-cloud-init.yaml")
-        )
+        log, netplan_cfg = _read_and_rotate_log(client)
+        assert "Applying network configuration" in log
+        assert "Selected renderer 'netplan'" in log
 
         client.restart()
 
-        log = client.read_from_file("/var/log/cloud-init.log")
+        log, netplan_cfg_new = client.read_from_files(
+            "/var/log/cloud-init.log", "/etc/netplan/50-cloud-init.yaml"
+        )
         assert "Event Allowed: scope=network EventType=boot" in log
         assert "Applying network configuration" in log
         assert (
@@ -116,10 +151,9 @@ class TestNetplanGenerateBehaviorOnReboot:
             " reason: identical netplan config"
         ) not in log
         assert "Running command ['netplan', 'generate']" in log
-        netplan_new = yaml.safe_load(
-            client.execute("cat /etc/netplan/50-cloud-init.yaml")
-        )
-        assert netplan != netplan_new, "changes expected in netplan config"
+        assert not _netplan_equal(
+            netplan_cfg, netplan_cfg_new
+        ), "changes expected in netplan config"
 
 
 NET_V1_CONFIG = """
@@ -341,8 +375,7 @@ def test_ec2_multi_nic_reboot(setup_image, session_cloud: IntegrationCloud):
         verify_clean_log(log_content)
 
         # SSH over primary and secondary NIC works
-        for ip in public_ips:
-            subp("nc -w 5 -zv " + ip + " 22", shell=True)
+        assert not get_unreachable_hosts(public_ips)
 
 
 @pytest.mark.adhoc  # costly instance not available in all regions / azs
@@ -410,20 +443,31 @@ def test_ec2_multi_network_cards(setup_image, session_cloud: IntegrationCloud):
             ]
         )
 
-        network_interfaces = iter(
-            ec2.describe_network_interfaces(
+        # The EC2 API calls below are independent, issue them concurrently
+        with ThreadPoolExecutor() as executor:
+            network_interfaces_future = executor.submit(
+                ec2.describe_network_interfaces,
                 Filters=[
                     {
                         "Name": "attachment.instance-id",
                         "Values": [client.instance.id],
                     }
-                ]
-            )["NetworkInterfaces"]
-        )
-        nic_id_0 = next(network_interfaces)["NetworkInterfaceId"]
+                ],
+            )
+            allocation_futures = [
+                executor.submit(ec2.allocate_address, Domain="vpc")
+                for _ in range(3)
+            ]
 
         try:
-            allocation_0 = ec2.allocate_address(Domain="vpc")
+            network_interfaces = iter(
+                network_interfaces_future.result()["NetworkInterfaces"]
+            )
+            allocation_0, allocation_1, allocation_2 = (
+                future.result() for future in allocation_futures
+            )
+
+            nic_id_0 = next(network_interfaces)["NetworkInterfaceId"]
             association_0 = ec2.associate_address(
                 AllocationId=allocation_0["AllocationId"],
                 NetworkInterfaceId=nic_id_0,
@@ -438,7 +482,6 @@ def test_ec2_multi_network_cards(setup_image, session_cloud: IntegrationCloud):
                 assert "network-card" in net_metadata
 
             nic_id_1 = next(network_interfaces)["NetworkInterfaceId"]
-            allocation_1 = ec2.allocate_address(Domain="vpc")
             association_1 = ec2.associate_address(
                 AllocationId=allocation_1["AllocationId"],
                 NetworkInterfaceId=nic_id_1,
@@ -446,7 +489,6 @@ def test_ec2_multi_network_cards(setup_image, session_cloud: IntegrationCloud):
             assert association_1["ResponseMetadata"]["HTTPStatusCode"] == 200
 
             nic_id_2 = next(network_interfaces)["NetworkInterfaceId"]
-            allocation_2 = ec2.allocate_address(Domain="vpc")
             association_2 = ec2.associate_address(
                 AllocationId=allocation_2["AllocationId"],
                 NetworkInterfaceId=nic_id_2,
@@ -461,24 +503,26 @@ def test_ec2_multi_network_cards(setup_image, session_cloud: IntegrationCloud):
             verify_clean_log(log_content)
 
             # SSH over secondary NICs works
-            subp("nc -w 5 -zv " + allocation_1["PublicIp"] + " 22", shell=True)
-            subp("nc -w 5 -zv " + allocation_2["PublicIp"] + " 22", shell=True)
+            assert not get_unreachable_hosts(
+                [allocation_1["PublicIp"], allocation_2["PublicIp"]]
+            )
         finally:
             with contextlib.suppress(Exception):
                 ec2.disassociate_address(
                     AssociationId=association_0["AssociationId"]
                 )
-            with contextlib.suppress(Exception):
-                ec2.release_address(AllocationId=allocation_0["AllocationId"])
             with contextlib.suppress(Exception):
                 ec2.disassociate_address(
                     AssociationId=association_1["AssociationId"]
                 )
-            with contextlib.suppress(Exception):
-                ec2.release_address(AllocationId=allocation_1["AllocationId"])
             with contextlib.suppress(Exception):
                 ec2.disassociate_address(
                     AssociationId=association_2["AssociationId"]
                 )
-            with contextlib.suppress(Exception):
-                ec2.release_address(AllocationId=allocation_2["AllocationId"])
+            # Release every address that got allocated, even if unpacking
+            # the allocations above failed
+            for future in allocation_futures:
+                with contextlib.suppress(Exception):
+                    ec2.release_address(
+                        AllocationId=future.result()["AllocationId"]
+                    )
@@ -1,20 +1,31 @@
+import errno
 import json
 import logging
 import multiprocessing
 import os
 import re
+import selectors
+import socket
 import time
 from collections import namedtuple
 from contextlib import contextmanager
 from functools import lru_cache
 from itertools import chain
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Optional, Set, Union
+from typing import TYPE_CHECKING, Iterable, List, Optional, Set, Union
 
 import pytest
 
 from cloudinit.subp import subp
 
+try:
+    # Prefer the libyaml backed implementations when they are available
+    from yaml import CSafeDumper as YamlSafeDumper  # noqa: F401
+    from yaml import CSafeLoader as YamlSafeLoader  # noqa: F401
+except ImportError:
+    from yaml import SafeDumper as YamlSafeDumper  # type: ignore # noqa: F401
+    from yaml import SafeLoader as YamlSafeLoader  # type: ignore # noqa: F401
+
 LOG = logging.getLogger("integration_testing.util")
 
 if TYPE_CHECKING:
@@ -316,6 +327,50 @@ def wait_for_cloud_init(client: "IntegrationInstance", num_retries: int = 30):
     ) from last_exception
 
 
+def get_unreachable_hosts(
+    ips: Iterable[str], port: int = 22, timeout: float = 5
+) -> List[str]:
+    """Return the ips which do not accept TCP connections on port.
+
+    Connections to all ips are attempted concurrently, so this takes at most
+    timeout seconds regardless of the number of ips.
+    """
+    unreachable = []
+    with selectors.DefaultSelector() as selector:
+        for ip in ips:
+            sock = socket.socket(
+                socket.AF_INET6 if ":" in ip else socket.AF_INET,
+                socket.SOCK_STREAM,
+            )
+            sock.setblocking(False)
+            if sock.connect_ex((ip, port)) in (0, errno.EINPROGRESS):
+                selector.register(sock, selectors.EVENT_WRITE, (ip, sock))
+            else:
+                unreachable.append(ip)
+                sock.close()
+
+        deadline = time.monotonic() + timeout
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            events = selector.select(remaining) if remaining > 0 else []
+            if not events:
+                break
+            for key, _ in events:
+                ip, sock = key.data
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    unreachable.append(ip)
+                selector.unregister(sock)
+                sock.close()
+
+        # Anything left did not connect in time
+        for key in list(selector.get_map().values()):
+            ip, sock = key.data
+            unreachable.append(ip)
+            selector.unregister(sock)
+            sock.close()
+    return unreachable
+
+
 def get_console_log(client: "IntegrationInstance"):
     try:
         console_log = client.instance.console_log()